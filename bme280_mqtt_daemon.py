@@ -5,12 +5,14 @@ Python script for reading a BME280 sensor on a raspberry pi and reporting back v
 
 import argparse
 import configparser
-import datetime
 import json
+import math
 import os
 import platform
 import signal
+import socket
 import sys
+import threading
 import time
 
 import bme280
@@ -30,12 +32,11 @@ MY_HOST = platform.node()
 
 SEALEVEL_MIN = -999
 
-SLEEP_TIME = 1  # in seconds
+PUBLISH_INTERVAL = 60  # in seconds
+CONNECT_TIMEOUT = 30  # in seconds
 SENSOR_STANDBY = 1000
-availability_topic = ""
-config_topics = None
-state_topic = ""
-read_loop = True
+SENSOR_SETTLE = 1  # in seconds, covers the first conversion in normal mode
+stop_event = threading.Event()
 
 
 class Options(object):
@@ -47,7 +48,16 @@ class Options(object):
         self.poffset = 0
         self.root_topic = ""
         self.elevation = SEALEVEL_MIN
-        self.mode = "normal"
+        self.mode = "forced"
+        self.keys = {}  # state JSON keys, built from the config section
+        self.availability_topic = ""
+        self.config_topics = None
+        self.state_topic = ""
+        self.discovery_payloads = []
+        self.connected_evt = threading.Event()
+        self.data = {}  # state payload, values overwritten on each publish
+        self.has_sealevel = False
+        self.sealevel_add = 0
 
 
 class Topics(object):
@@ -80,10 +90,44 @@ class SensorData(object):
 def receive_signal(signal_number, frame):
     """function to attach to a signal handler, and simply exit"""
 
-    global read_loop
-
     print("Received signal: ", signal_number)
-    read_loop = False
+    stop_event.set()
+
+
+def build_discovery_payloads(options):
+    """Build the Home Assistant discovery (topic, payload) pairs once"""
+
+    config_topics = options.config_topics
+    sensor_configs = [
+        ["Temperature", "°C", "temperature", config_topics.temperature, "temp"],
+        ["Humidity", "%", "humidity", config_topics.humidity, "hum"],
+        ["Pressure", "hPa", "pressure", config_topics.pressure, "press"],
+    ]
+
+    if options.has_sealevel:
+        sensor_configs.append(
+            ["Sealevel", "hPa", "pressure", config_topics.sealevel_pressure, "sea"]
+        )
+
+    payloads = []
+    for sensor in sensor_configs:
+        ha_sensor_config = {
+            "availability_topic": options.availability_topic,
+            "device_class": sensor[2],
+            "device": {"identifiers": MY_HOST, "name": f"{MY_HOST} Sensor"},
+            "enabled_by_default": True,
+            "name": sensor[0],
+            "state_class": "measurement",
+            "state_topic": options.state_topic,
+            "unique_id": f"{MY_HOST}_{sensor[0]}".lower(),
+            "unit_of_measurement": sensor[1],
+            "value_template": f"{{{{ value_json.{options.keys[sensor[4]]} }}}}",
+        }
+        payloads.append(
+            (sensor[3], json.dumps(ha_sensor_config, separators=(",", ":")).encode())
+        )
+
+    return payloads
 
 
 def on_connect(client, userdata, flags, return_code):
@@ -92,42 +136,22 @@ def on_connect(client, userdata, flags, return_code):
     if return_code != 0:
         print("Connected with result code: ", str(return_code))
     else:
-        client.connected_flag = True
+        userdata.connected_evt.set()
 
-        sensor_configs = [
-            ["Temperature", "°C", "temperature", config_topics.temperature],
-            ["Humidity", "%", "humidity", config_topics.humidity],
-            ["Pressure", "hPa", "pressure", config_topics.pressure],
-        ]
+        # Disable Nagle so the back-to-back discovery publishes are not delayed
+        sock = client.socket()
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        if userdata.elevation > SEALEVEL_MIN:
-            sensor_configs.append(
-                ["Sealevel", "hPa", "pressure", config_topics.sealevel_pressure]
-            )
+        # Configure sensors
+        for topic, payload in userdata.discovery_payloads:
+            client.publish(topic, payload, qos=1, retain=True)
 
-        for sensor in sensor_configs:
-            # Configure sensor
-            ha_sensor_config = {
-                "availability_topic": availability_topic,
-                "device_class": sensor[2],
-                "device": {"identifiers": MY_HOST, "name": f"{MY_HOST} Sensor"},
-                "enabled_by_default": True,
-                "name": sensor[0],
-                "state_class": "measurement",
-                "state_topic": state_topic,
-                "unique_id": f"{MY_HOST}_{sensor[0]}".lower(),
-                "unit_of_measurement": sensor[1],
-                "value_template": f"{{{{ value_json.{userdata.section}_{sensor[0].lower()} }}}}",
-            }
-            client.publish(sensor[3], json.dumps(ha_sensor_config), retain=True)
-
-            # Mark sensor as online
-            client.publish(availability_topic, "online", retain=True)
-
-
-def publish_mqtt(
-    client, sensor_data, options, config_topics, file_handle, verbose=False
-):
+        # Mark sensors as online, once all of them are configured
+        client.publish(userdata.availability_topic, "online", qos=1, retain=True)
+
+
+def publish_mqtt(client, sensor_data, options, file_handle, verbose=False):
     """Publish the sensor data to MQTT in JSON format"""
 
     hum = sensor_data.humidity + options.hoffset
@@ -138,40 +162,60 @@ def publish_mqtt(
 
     press_A = sensor_data.pressure + options.poffset
 
-    # https://www.sandhurstweather.org.uk/barometric.pdf
-    if options.elevation > SEALEVEL_MIN:
-        # option one: Sea Level Pressure = Station Pressure / e ** -elevation / (temperature x 29.263)
-        # press_S = press_A / math.exp( - elevation / (temp_K * 29.263))
-        # option two: Sea Level Pressure = Station Pressure + (elevation/9.2)
-        press_S = press_A + (options.elevation / 9.2)
+    data = options.data
+
+    data[options.keys["hum"]] = round(hum, 1)
+    data[options.keys["temp"]] = round(temp_C, 1)
+    data[options.keys["press"]] = round(press_A, 2)
+
+    if options.has_sealevel:
+        press_S = press_A + options.sealevel_add
+        data[options.keys["sea"]] = round(press_S, 2)
     else:
         press_S = press_A
 
-    curr_datetime = datetime.datetime.now()
-
     if verbose:
-        str_datetime = curr_datetime.strftime("%Y-%m-%d %H:%M:%S")
+        str_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
         print(
-            "{0}: temperature: {1:.1f}ºC, humidity: {2:.1f} %RH, pressure: {3:.2f} hPa, sealevel: {4:.2f} hPa".format(
-                str_datetime, temp_C, hum, press_A, press_S
-            ),
+            f"{str_datetime}: temperature: {temp_C:.1f}ºC, humidity: {hum:.1f} %RH, pressure: {press_A:.2f} hPa, sealevel: {press_S:.2f} hPa",
             file=file_handle,
         )
-        file_handle.flush()
 
-    data = {}
+    # data['Time'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    # QoS 0 and no retain: fire-and-forget, no ack round-trip per publish
+    client.publish(
+        options.state_topic,
+        json.dumps(data, separators=(",", ":")),
+        qos=0,
+        retain=False,
+    )
+
+    return
 
-    data[f"{options.section}_humidity"] = round(hum, 1)
-    data[f"{options.section}_temperature"] = round(temp_C, 1)
-    data[f"{options.section}_pressure"] = round(press_A, 2)
-    if options.elevation > SEALEVEL_MIN:
-        data[f"{options.section}_sealevel"] = round(press_S, 2)
 
-    # data['Time'] = curr_datetime.replace(microsecond=0).isoformat()
+def setup_sensor(sensor, options, file_handle):
+    """(Re-)initialise the BME280, return True when it is ready to be read"""
 
-    client.publish(state_topic, json.dumps(data))
+    sensor._is_setup = False
+    try:
+        # sensor.setup(mode=options.mode, temperature_standby=SENSOR_STANDBY) # Sync to sleep() call (in ms), when in normal mode
+        sensor.setup(mode=options.mode)
+    except (OSError, RuntimeError) as err:
+        # setup() reports a failed chip ID read as RuntimeError
+        str_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+        print(
+            f"{str_datetime}: pid: {os.getpid():d} bme280 sensor setup failed ({err})",
+            file=file_handle,
+        )
+        return False
 
-    return
+    if options.mode != "forced":
+        # Normal mode converts in the background; until the first conversion
+        # completes the data registers still hold their reset values
+        stop_event.wait(SENSOR_SETTLE)
+
+    return True
 
 
 def start_daemon(args):
@@ -198,18 +242,15 @@ def start_bme280_sensor(args):
     """Main program function, parse arguments, read configuration,
     setup client, listen for messages"""
 
-    global availability_topic, config_topics, state_topic, read_loop
-
     i2c_address = bme280.I2C_ADDRESS_GND  # 0x76, alt is 0x77
 
     options = Options()
 
     if args.daemon:
-        file_handle = open(args.log_file, "w")
+        file_handle = open(args.log_file, "w", buffering=1)  # line buffered
     else:
         file_handle = sys.stdout
 
-    mqtt.Client.connected_flag = False
     client = mqtt.Client(
         mqtt.CallbackAPIVersion.VERSION1, args.clientid, userdata=options
     )
@@ -218,43 +259,51 @@ def start_bme280_sensor(args):
     mqtt_conf.read(args.config)
 
     options.section = args.section
+    options.keys = {
+        "hum": f"{args.section}_humidity",
+        "temp": f"{args.section}_temperature",
+        "press": f"{args.section}_pressure",
+        "sea": f"{args.section}_sealevel",
+    }
 
-    options.root_topic = mqtt_conf.get(args.section, "topic")
-
-    availability_topic = f"{options.root_topic}/sensor/{MY_HOST}/status"
-    config_topics = Topics(options.root_topic, args.section)
-    state_topic = f"{options.root_topic}/sensor/{MY_HOST}/state"
-
-    if mqtt_conf.has_option(args.section, "address"):
-        i2c_address = int(mqtt_conf.get(args.section, "address"), 0)
-
-    if mqtt_conf.has_option(args.section, "mode"):
-        options.mode = mqtt_conf.get(args.section, "mode")
+    # Materialize the section once instead of repeated has_option/get lookups
+    section_conf = dict(mqtt_conf.items(args.section))
 
-    if mqtt_conf.has_option(args.section, "toffset"):
-        options.toffset = float(mqtt_conf.get(args.section, "toffset"))
+    options.root_topic = section_conf["topic"]
 
-    if mqtt_conf.has_option(args.section, "hoffset"):
-        options.hoffset = float(mqtt_conf.get(args.section, "hoffset"))
+    options.availability_topic = f"{options.root_topic}/sensor/{MY_HOST}/status"
+    options.config_topics = Topics(options.root_topic, args.section)
+    options.state_topic = f"{options.root_topic}/sensor/{MY_HOST}/state"
 
-    if mqtt_conf.has_option(args.section, "poffset"):
-        options.poffset = float(mqtt_conf.get(args.section, "poffset"))
+    if "address" in section_conf:
+        i2c_address = int(section_conf["address"], 0)
 
-    if mqtt_conf.has_option(args.section, "elevation"):
-        options.elevation = float(mqtt_conf.get(args.section, "elevation"))
+    options.mode = section_conf.get("mode", options.mode)
+    options.toffset = float(section_conf.get("toffset", options.toffset))
+    options.hoffset = float(section_conf.get("hoffset", options.hoffset))
+    options.poffset = float(section_conf.get("poffset", options.poffset))
+    options.elevation = float(section_conf.get("elevation", options.elevation))
 
-    if mqtt_conf.has_option(args.section, "format"):
-        options.format = mqtt_conf.get(args.section, "format")
+    # https://www.sandhurstweather.org.uk/barometric.pdf
+    # option one: Sea Level Pressure = Station Pressure / e ** -elevation / (temperature x 29.263)
+    # press_S = press_A / math.exp( - elevation / (temp_K * 29.263))
+    # option two: Sea Level Pressure = Station Pressure + (elevation/9.2)
+    options.has_sealevel = options.elevation > SEALEVEL_MIN
+    if options.has_sealevel:
+        options.sealevel_add = options.elevation / 9.2
+
+    if "format" in section_conf:
+        options.format = section_conf["format"]
+
+    if "username" in section_conf and "password" in section_conf:
+        client.username_pw_set(
+            username=section_conf["username"], password=section_conf["password"]
+        )
 
-    if mqtt_conf.has_option(args.section, "username") and mqtt_conf.has_option(
-        args.section, "password"
-    ):
-        username = mqtt_conf.get(args.section, "username")
-        password = mqtt_conf.get(args.section, "password")
-        client.username_pw_set(username=username, password=password)
+    options.discovery_payloads = build_discovery_payloads(options)
 
-    host = mqtt_conf.get(args.section, "host")
-    port = int(mqtt_conf.get(args.section, "port"))
+    host = section_conf["host"]
+    port = int(section_conf["port"])
 
     client.on_connect = on_connect
     # client.on_disconnect = on_disconnect
@@ -263,87 +312,104 @@ def start_bme280_sensor(args):
     # client.loop_start()
 
     # Wait for valid connection
-    while not client.connected_flag:  # wait in loop
-        time.sleep(10)
+    if not options.connected_evt.wait(timeout=CONNECT_TIMEOUT):
+        str_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+        print(
+            f"{str_datetime}: pid: {os.getpid():d}, no MQTT connection to {host:s}:{port:d} after {CONNECT_TIMEOUT:d} s",
+            file=file_handle,
+        )
+        file_handle.flush()
+        client.loop_stop()
+        sys.exit(1)
+
+    # A stop signal may already have arrived while connecting
+    if stop_event.is_set():
+        stop_bme280_sensor(client, options, file_handle)
+        return
 
     # Initialise the BME280
     bus = SMBus(1)
 
     sensor = bme280.BME280(i2c_addr=i2c_address, i2c_dev=bus)
 
-    # print("pre setup = {0}".format(sensor._is_setup))
-    # sensor.setup(mode=options.mode, temperature_standby=SENSOR_STANDBY) # Sync to sleep() call (in ms), when in normal mode
-    sensor.setup(mode=options.mode)
-    # print("post setup = {0}".format(sensor._is_setup))
+    # print(f"pre setup = {sensor._is_setup}")
+    sensor_ready = setup_sensor(sensor, options, file_handle)
+    # print(f"post setup = {sensor._is_setup}")
 
     sensor_data = (
         SensorData()
     )  # Initialize a sensor_data object to hold the information
 
-    first_read = (
-        True  # problems with the first read of the data? seems ok in forced mode.
-    )
-    read_loop = True
-
-    curr_datetime = datetime.datetime.now()
-    str_datetime = curr_datetime.strftime("%Y-%m-%d %H:%M:%S")
+    str_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
     print(
-        "{0}: pid: {1:d}, bme280 sensor started on 0x{2:x}, mode: {3:s}, toffset: {4:0.1f} C, hoffset: {5:0.1f} %, poffset: {6:0.2f} hPa".format(
-            str_datetime,
-            os.getpid(),
-            i2c_address,
-            options.mode,
-            options.toffset,
-            options.hoffset,
-            options.poffset,
-        ),
+        f"{str_datetime}: pid: {os.getpid():d}, bme280 sensor started on 0x{i2c_address:x}, mode: {options.mode:s}, toffset: {options.toffset:0.1f} C, hoffset: {options.hoffset:0.1f} %, poffset: {options.poffset:0.2f} hPa",
         file=file_handle,
     )
     file_handle.flush()
 
-    while read_loop:
-        curr_time = time.time()
-        my_time = int(round(curr_time))
-        sensor_data.temperature = sensor.get_temperature()
-        sensor_data.humidity = sensor.get_humidity()
-        sensor_data.pressure = sensor.get_pressure()
+    # Align the first publish to the wall-clock minute, then schedule on the
+    # monotonic clock so publishes neither drift nor repeat
+    next_tick = math.ceil(time.time() / PUBLISH_INTERVAL) * PUBLISH_INTERVAL
+    next_deadline = time.monotonic() + (next_tick - time.time())
+
+    # Waiting on the event rather than sleeping lets a signal end the loop at once
+    while not stop_event.wait(timeout=max(0, next_deadline - time.monotonic())):
+        next_deadline += PUBLISH_INTERVAL
 
-        if not first_read and sensor_data.pressure < 800:
-            curr_datetime = datetime.datetime.now()
-            str_datetime = curr_datetime.strftime("%Y-%m-%d %H:%M:%S")
+        if not sensor_ready:
+            # Retry a failed setup; the first read follows one interval later
+            sensor_ready = setup_sensor(sensor, options, file_handle)
+            continue
+
+        try:
+            # One conversion, one burst read of the data registers and one
+            # compensation pass (t_fine is shared by T, P and H); the get_*
+            # accessors would each trigger their own update_sensor()
+            sensor.update_sensor()
+        except (OSError, RuntimeError) as err:
+            fault = f"I2C error: {err}"
+        else:
+            # Secondary guard: an implausible reading means the chip lost its setup
+            fault = "implausible pressure" if sensor.pressure < 800 else None
+
+        if fault:
+            str_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
             print(
-                "{0}: pid: {1:d} bme280 sensor fault - reset".format(
-                    str_datetime, os.getpid()
-                )
+                f"{str_datetime}: pid: {os.getpid():d} bme280 sensor fault ({fault}) - reset",
+                file=file_handle,
             )
-            sensor._is_setup = False
-            sensor.setup(mode=options.mode)
-            time.sleep(SLEEP_TIME)
+            # Re-setup now so the next read is a full interval later
+            sensor_ready = setup_sensor(sensor, options, file_handle)
             continue
 
-        if my_time % 60 == 0:
-            if not first_read:
-                publish_mqtt(
-                    client,
-                    sensor_data,
-                    options,
-                    config_topics,
-                    file_handle,
-                    args.verbose,
-                )
-            first_read = False
-            # done_time = time.time()
-            # print("difference = {0}".format(done_time - curr_time))
-
-        time.sleep(SLEEP_TIME)
-
-    curr_datetime = datetime.datetime.now()
-    str_datetime = curr_datetime.strftime("%Y-%m-%d %H:%M:%S")
+        sensor_data.temperature = sensor.temperature
+        sensor_data.humidity = sensor.humidity
+        sensor_data.pressure = sensor.pressure
+
+        publish_mqtt(
+            client,
+            sensor_data,
+            options,
+            file_handle,
+            args.verbose,
+        )
+
+    stop_bme280_sensor(client, options, file_handle)
+
+
+def stop_bme280_sensor(client, options, file_handle):
+    """Log the interruption, mark the sensors offline and disconnect"""
+
+    str_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
     print(
-        "{0}: pid: {1:d}, bme280 sensor interrupted".format(str_datetime, os.getpid()),
+        f"{str_datetime}: pid: {os.getpid():d}, bme280 sensor interrupted",
         file=file_handle,
     )
-    client.publish(availability_topic, "offline", retain=True)
+    file_handle.flush()
+    msg_info = client.publish(options.availability_topic, "offline", qos=1, retain=True)
+    if msg_info.rc == mqtt.MQTT_ERR_SUCCESS:
+        # Only wait when the message was queued; waiting raises if not connected
+        msg_info.wait_for_publish(timeout=5)
 
     client.loop_stop()
     client.disconnect()